@@ -1,7 +1,6 @@
 import os
 
 from lxml import etree
-from xml.etree import ElementTree as xml_tree
 from inkex import EffectExtension, Boolean
 
 from svg_to_gcode.svg_parser import parse_root, Transformation, debug_methods
@@ -13,6 +12,19 @@ svg_name_space = "http://www.w3.org/2000/svg"
 inkscape_name_space = "http://www.inkscape.org/namespaces/inkscape"
 sodipodi_name_space = "http://sodipodi.sourceforge.net/DTD/sodipodi-0.dtd"
 
+# Qualified names, expanded once instead of on every call
+svg_group_tag = "{%s}g" % svg_name_space
+svg_line_tag = "{%s}line" % svg_name_space
+svg_text_tag = "{%s}text" % svg_name_space
+inkscape_groupmode = "{%s}groupmode" % inkscape_name_space
+inkscape_label = "{%s}label" % inkscape_name_space
+inkscape_current_layer = "{%s}current-layer" % inkscape_name_space
+sodipodi_namedview_tag = "{%s}namedview" % sodipodi_name_space
+
+# Compiled once, lxml reuses the XPath object on every call
+find_debug_groups = etree.XPath("./svg:g[@id='debug_traces' or @id='debug_references']",
+                                namespaces={"svg": svg_name_space})
+
 inx_filename = "laser.inx"
 
 
@@ -26,14 +38,86 @@ def generate_custom_interface(laser_off_command, laser_power_command):
             super().__init__()
 
         def laser_off(self):
-            return f"{laser_off_command}"
+            return laser_off_command
 
         def set_laser_power(self, _):
-            return f"{laser_power_command}"
+            return laser_power_command
 
     return CustomInterface
 
 
+def _et_to_lxml(et_element, lxml_parent):
+    """
+    Copies an xml.etree element (as returned by svg_to_gcode's debug_methods) under an lxml parent, without a
+    serialize/parse round trip.
+    """
+    lxml_element = etree.SubElement(lxml_parent, et_element.tag, attrib=dict(et_element.attrib))
+    lxml_element.text = et_element.text
+    lxml_element.tail = et_element.tail
+
+    for et_child in et_element:
+        _et_to_lxml(et_child, lxml_element)
+
+    return lxml_element
+
+
+def _read_commands(path):
+    """Reads a header/footer file in one go and splits it into a list of commands, as Compiler expects a list."""
+    with open(path, 'r') as file:
+        return file.read().splitlines()
+
+
+def _next_free(filename, extension):
+    """
+    Returns the first path of the form filename + n + extension (n >= 1) that doesn't exist yet. Assumes suffixes are
+    taken contiguously from 1, which lets us probe exponentially and then binary search instead of checking every n.
+    """
+    taken, n = 0, 1
+    while os.path.isfile(f"{filename}{n}{extension}"):
+        taken, n = n, n * 2
+
+    # Invariant: taken is in use (or 0), n is free
+    while n - taken > 1:
+        middle = (taken + n) // 2
+        if os.path.isfile(f"{filename}{middle}{extension}"):
+            taken = middle
+        else:
+            n = middle
+
+    return f"{filename}{n}{extension}"
+
+
+def _parse_inx(path):
+    """Reads the arguments declared as params in an inx file"""
+    arguments = []  # [{name, type, ...}]
+    namespace = "http://www.inkscape.org/namespace/inkscape/extension"
+    param_tag = "{%s}param" % namespace
+    page_tag = "{%s}page" % namespace
+    types = {"int": int, "float": float, "bool": Boolean, "string": str, "optiongroup": str, "path": str}
+
+    has_page = False
+    for _, element in etree.iterparse(path, events=("end",), tag=(param_tag, page_tag)):
+        if element.tag == page_tag:
+            has_page = True
+        else:
+            name = element.attrib["name"]
+
+            arg_type = element.attrib["type"]
+
+            if arg_type not in ["description", "notebook"]:
+                arguments.append({"name": name, "type": types[arg_type]})
+
+        # Nothing is needed once an element has been read, so free it and any siblings parsed before it
+        element.clear()
+        while element.getprevious() is not None:
+            del element.getparent()[0]
+
+    if has_page:
+        arguments.append({"name": "tabs", "type": str})
+
+    return arguments
+
+
 class GcodeExtension(EffectExtension):
     """Inkscape Effect Extension."""
 
@@ -48,41 +132,29 @@ class GcodeExtension(EffectExtension):
         # Change svg_to_gcode's approximation tolerance
         TOLERANCES["approximation"] = float(self.options.approximation_tolerance.replace(',', '.'))
 
-        # Construct output path
         # Construct output path
         if self.options.filename_dynamic and self.document_path():
-            filename, extension = self.document_path().split('.')
-            filename = filename.split('/')[-1] + '.gcode'
+            filename = os.path.splitext(os.path.basename(self.document_path()))[0] + '.gcode'
             output_path = os.path.join(self.options.directory, filename)
         else:
             output_path = os.path.join(self.options.directory, self.options.filename)
 
-        if self.options.filename_suffix:
-            try:
-                filename, extension = output_path.split('.')
-            except:
-                self.msg("Error in output directory!")
-                exit(1)
-
-            n = 1
-            while os.path.isfile(output_path):
-                output_path = filename + str(n) + '.' + extension
-                n += 1
+        if self.options.filename_suffix and os.path.isfile(output_path):
+            filename, extension = os.path.splitext(output_path)
+            output_path = _next_free(filename, extension)
 
         # Load header and footer files
         header = []
         if self.options.header_path is not None:
             if os.path.isfile(self.options.header_path):
-                with open(self.options.header_path, 'r') as header_file:
-                    header = header_file.read().splitlines()
+                header = _read_commands(self.options.header_path)
             elif self.options.header_path != os.getcwd():  # The Inkscape file selector defaults to the working directory
                 self.debug(f"Header file does not exist at {self.options.header_path}")
 
         footer = []
         if self.options.footer_path is not None:
             if os.path.isfile(self.options.footer_path):
-                with open(self.options.footer_path, 'r') as footer_file:
-                    footer = footer_file.read().splitlines()
+                footer = _read_commands(self.options.footer_path)
             elif self.options.footer_path != os.getcwd():
                 self.debug(f"Footer file does not exist at {self.options.footer_path}")
 
@@ -119,54 +191,57 @@ class GcodeExtension(EffectExtension):
         curves = parse_root(root, transform_origin=not self.options.invert_y_axis, root_transformation=transformation,
                             canvas_height=self.options.bed_height)
 
-        gcode_compiler.append_curves(curves)
+        # Approximate every curve once and share the line chains between the compiler and the debug traces
+        approximations = [LineSegmentChain.line_segment_approximation(curve) for curve in curves]
+
+        for approximation in approximations:
+            gcode_compiler.append_line_chain(approximation)
+
         gcode_compiler.compile_to_file(output_path, passes=self.options.passes)
 
         # Draw debug lines
         self.clear_debug()
         if self.options.draw_debug:
-            self.draw_debug_traces(curves)
+            self.draw_debug_traces(approximations)
             self.draw_unit_reference()
             self.select_non_debug_layer()
 
         return self.document
 
-    def draw_debug_traces(self, curves):
-        """Traces arrows over all parsed paths"""
+    def draw_debug_traces(self, approximations):
+        """Traces arrows over all parsed paths, given as the LineSegmentChains they were approximated by"""
+
+        if not approximations:
+            return
 
         root = self.document.getroot()
         origin = self.options.machine_origin
         bed_width = self.options.bed_width
         bed_height = self.options.bed_height
 
-        group = etree.Element("{%s}g" % svg_name_space)
-        group.set("id", "debug_traces")
-        group.set("{%s}groupmode" % inkscape_name_space, "layer")
-        group.set("{%s}label" % inkscape_name_space, "debug traces")
+        group = etree.Element(svg_group_tag, attrib={
+            "id": "debug_traces", inkscape_groupmode: "layer", inkscape_label: "debug traces"
+        })
 
-        group.append(
-            etree.fromstring(xml_tree.tostring(debug_methods.arrow_defs(arrow_scale=self.options.debug_arrow_scale))))
+        _et_to_lxml(debug_methods.arrow_defs(arrow_scale=self.options.debug_arrow_scale), group)
 
-        for curve in curves:
-            approximation = LineSegmentChain.line_segment_approximation(curve)
+        # The origin change doesn't depend on the curve, so build it once for all paths
+        change_origin = Transformation()
 
-            change_origin = Transformation()
+        if not self.options.invert_y_axis:
+            change_origin.add_scale(1, -1)
+            change_origin.add_translation(0, -bed_height)
 
-            if not self.options.invert_y_axis:
-                change_origin.add_scale(1, -1)
-                change_origin.add_translation(0, -bed_height)
+        if origin == "center":
+            change_origin.add_translation(bed_width / 2, bed_height / 2)
 
-            if origin == "center":
-                change_origin.add_translation(bed_width / 2, bed_height / 2)
+        stroke_width = f"{self.options.debug_line_width}px"
 
+        for approximation in approximations:
+            path = debug_methods.to_svg_path(approximation, color="red", opacity="0.5", stroke_width=stroke_width,
+                                             transformation=change_origin, draw_arrows=True)
 
-
-            path_string = xml_tree.tostring(
-                debug_methods.to_svg_path(approximation, color="red", opacity="0.5", stroke_width=f"{self.options.debug_line_width}px",
-                                          transformation=change_origin, draw_arrows=True)
-            )
-
-            group.append(etree.fromstring(path_string))
+            _et_to_lxml(path, group)
 
         root.append(group)
 
@@ -178,10 +253,9 @@ class GcodeExtension(EffectExtension):
         bed_width = self.options.bed_width
         bed_height = self.options.bed_height
 
-        group = etree.Element("{%s}g" % svg_name_space)
-        group.set("id", "debug_references")
-        group.set("{%s}groupmode" % inkscape_name_space, "layer")
-        group.set("{%s}label" % inkscape_name_space, "debug reference points")
+        group = etree.Element(svg_group_tag, attrib={
+            "id": "debug_references", inkscape_groupmode: "layer", inkscape_label: "debug reference points"
+        })
 
         reference_points_svg = [(0, 0), (0, bed_height), (bed_width, 0), (bed_width, bed_height)]
         reference_points_gcode = {
@@ -191,41 +265,33 @@ class GcodeExtension(EffectExtension):
                        (bed_width / 2, bed_height / 2),
                        (bed_width / 2, -bed_height / 2)]
         }[origin]
-        for i, (x, y) in enumerate(reference_points_svg):
-            reference_point = etree.Element("{%s}g" % svg_name_space)
 
-            stroke_width = 2
-            size = 7
+        stroke_width = 2
+        size = 7
+        style = f"stroke:black;stroke-width:{stroke_width}"
+
+        for (x, y), (gcode_x, gcode_y) in zip(reference_points_svg, reference_points_gcode):
+            reference_point = etree.SubElement(group, svg_group_tag)
+            plus_sign = etree.SubElement(reference_point, svg_group_tag)
 
             x_direction = -1 if x > 0 else 1
-            plus_sign = etree.Element("{%s}g" % svg_name_space)
-            horizontal = etree.Element("{%s}line" % svg_name_space)
-            horizontal.set("x1", str(x - x_direction * stroke_width / 2))
-            horizontal.set("y1", str(y))
-            horizontal.set("x2", str(x + x_direction * size))
-            horizontal.set("y2", str(y))
-            horizontal.set("style", f"stroke:black;stroke-width:{stroke_width}")
-            plus_sign.append(horizontal)
+            etree.SubElement(plus_sign, svg_line_tag, attrib={
+                "x1": str(x - x_direction * stroke_width / 2), "y1": str(y),
+                "x2": str(x + x_direction * size), "y2": str(y),
+                "style": style
+            })
 
             y_direction = -1 if y > 0 else 1
-            vertical = etree.Element("{%s}line" % svg_name_space)
-            vertical.set("x1", str(x))
-            vertical.set("y1", str(y + stroke_width / 2))
-            vertical.set("x2", str(x))
-            vertical.set("y2", str(y + y_direction * size))
-            vertical.set("style", f"stroke:black;stroke-width:{stroke_width}")
-            plus_sign.append(vertical)
-
-            reference_point.append(plus_sign)
-
-            text_box = etree.Element("{%s}text" % svg_name_space)
-            text_box.set("x", str(x - 28))
-            text_box.set("y", str(y - (y <= 0) * 6 + (y > 0) * 9))
-            text_box.set("font-size", "6")
-            text_box.text = f"{reference_points_gcode[i][0]}{unit}, {reference_points_gcode[i][1]}{unit}"
-            reference_point.append(text_box)
+            etree.SubElement(plus_sign, svg_line_tag, attrib={
+                "x1": str(x), "y1": str(y + stroke_width / 2),
+                "x2": str(x), "y2": str(y + y_direction * size),
+                "style": style
+            })
 
-            group.append(reference_point)
+            text_box = etree.SubElement(reference_point, svg_text_tag, attrib={
+                "x": str(x - 28), "y": str(y - (y <= 0) * 6 + (y > 0) * 9), "font-size": "6"
+            })
+            text_box.text = f"{gcode_x}{unit}, {gcode_y}{unit}"
 
         root.append(group)
 
@@ -238,17 +304,16 @@ class GcodeExtension(EffectExtension):
         root = self.document.getroot()
 
         unique_id = "layer89324"
-        content_layer = root.find("{%s}g[@id='%s']" % (svg_name_space, unique_id))
+        content_layer = root.find("%s[@id='%s']" % (svg_group_tag, unique_id))
 
         if content_layer is None:
-            content_layer = etree.Element("{%s}g" % svg_name_space)
-            content_layer.set("id", unique_id)
-            content_layer.set("{%s}groupmode" % inkscape_name_space, "layer")
-            content_layer.set("{%s}label" % inkscape_name_space, "content layer")
+            content_layer = etree.Element(svg_group_tag, attrib={
+                "id": unique_id, inkscape_groupmode: "layer", inkscape_label: "content layer"
+            })
 
-        sodipodi = root.find("{%s}namedview" % sodipodi_name_space)
+        sodipodi = root.find(sodipodi_namedview_tag)
         if sodipodi is not None:
-            sodipodi.set("{%s}current-layer" % inkscape_name_space, unique_id)
+            sodipodi.set(inkscape_current_layer, unique_id)
 
         root.append(content_layer)
 
@@ -256,14 +321,8 @@ class GcodeExtension(EffectExtension):
         """Removes debug groups. Used before parsing paths for gcode."""
         root = self.document.getroot()
 
-        debug_traces = root.find("{%s}g[@id='debug_traces']" % svg_name_space)
-        debug_references = root.find("{%s}g[@id='debug_references']" % svg_name_space)
-
-        if debug_traces is not None:
-            root.remove(debug_traces)
-
-        if debug_references is not None:
-            root.remove(debug_references)
+        for debug_group in find_debug_groups(root):
+            root.remove(debug_group)
 
     def add_arguments(self, arg_parser):
         """Tell inkscape what arguments to stick in self.options (behind the hood it's more complicated, see docs)"""
@@ -277,27 +336,7 @@ class GcodeExtension(EffectExtension):
         """
         This method reads arguments off of the inx file so you don't have to explicitly declare them in self.add_arguments()
         """
-        root = etree.parse(inx_filename).getroot()
-
-        arguments = []  # [{name, type, ...}]
-        namespace = "http://www.inkscape.org/namespace/inkscape/extension"
-        for arg in root.iter("{%s}param" % namespace):
-
-            name = arg.attrib["name"]
-
-            arg_type = arg.attrib["type"]
-
-            if arg_type in ["description", "notebook"]:
-                continue
-
-            types = {"int": int, "float": float, "bool": Boolean, "string": str, "optiongroup": str, "path": str}
-
-            arguments.append({"name": name, "type": types[arg_type]})
-
-        if next(root.iter("{%s}page" % namespace)) is not None:
-            arguments.append({"name": "tabs", "type": str})
-
-        return arguments
+        return _parse_inx(inx_filename)
 
 
 if __name__ == '__main__':